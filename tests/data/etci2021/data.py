@@ -7,10 +7,13 @@ import hashlib
 import os
 import shutil
 
+import numpy as np
 from PIL import Image
 
 SIZE = 64  # image width/height
 
+np.random.seed(0)
+
 metadatas = [
     {
         'filename': 'train.zip',
@@ -66,7 +69,12 @@ for metadata in metadatas:
             fd = os.path.join(directory, subdir, 'tiles', tile)
             os.makedirs(fd)
 
-            img = Image.new('RGB', (SIZE, SIZE))
+            # RGB PNGs with identical channels, like the real dataset
+            if tile in ['vh', 'vv']:
+                array = np.random.randint(0, 256, (SIZE, SIZE), dtype=np.uint8)
+            else:
+                array = np.random.randint(0, 2, (SIZE, SIZE), dtype=np.uint8) * 255
+            img = Image.fromarray(np.stack([array] * 3, axis=-1))
             img.save(os.path.join(fd, fn))
 
     # Compress data
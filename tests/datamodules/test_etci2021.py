@@ -0,0 +1,20 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+
+import torch
+
+from torchgeo.datamodules import ETCI2021DataModule
+
+
+class TestETCI2021DataModule:
+    def test_channels_last(self) -> None:
+        root = os.path.join('tests', 'data', 'etci2021')
+        dm = ETCI2021DataModule(
+            root=root, batch_size=2, num_workers=1, memory_format=torch.channels_last
+        )
+        dm.setup('validate')
+        batch = next(iter(dm.val_dataloader()))
+        batch = dm.on_after_batch_transfer(batch, 0)
+        assert batch['image'].is_contiguous(memory_format=torch.channels_last)
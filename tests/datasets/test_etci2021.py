@@ -1,19 +1,37 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import json
 import os
+import pickle
 from pathlib import Path
 
 import matplotlib.pyplot as plt
+import numpy as np
 import pytest
 import torch
 import torch.nn as nn
 from _pytest.fixtures import SubRequest
+from PIL import Image
 from pytest import MonkeyPatch
 
+import torchgeo.datasets.etci2021
 from torchgeo.datasets import ETCI2021, DatasetNotFoundError
 
 
+def expected(dataset: ETCI2021, index: int) -> tuple[torch.Tensor, torch.Tensor]:
+    bands = {}
+    for key, paths in dataset.files.items():
+        with Image.open(paths[index]) as img:
+            bands[key] = torch.from_numpy(np.array(img)[..., 0])
+    image = torch.stack([bands['vv'], bands['vh']])
+    masks = [bands['water_mask']]
+    if 'flood_mask' in bands:
+        masks.append(bands['flood_mask'])
+    mask = (torch.stack(masks) > 0).to(torch.uint8)
+    return image, mask
+
+
 class TestETCI2021:
     @pytest.fixture(params=['train', 'val', 'test'])
     def dataset(
@@ -23,19 +41,19 @@ class TestETCI2021:
         metadata = {
             'train': {
                 'filename': 'train.zip',
-                'md5': 'bd55f2116e43a35d5b94a765938be2aa',
+                'md5': '5200eb9029ae77a6535b6574af741642',
                 'directory': 'train',
                 'url': os.path.join(data_dir, 'train.zip'),
             },
             'val': {
                 'filename': 'val_with_ref_labels.zip',
-                'md5': '96ed69904043e514c13c14ffd3ec45cd',
+                'md5': '8add7074aa193c548bdc5929a657ab02',
                 'directory': 'test',
                 'url': os.path.join(data_dir, 'val_with_ref_labels.zip'),
             },
             'test': {
                 'filename': 'test_without_ref_labels.zip',
-                'md5': '1b66d85e22c8f5b0794b3542c5ea09ef',
+                'md5': 'b51ce63f21f3001858883b6444cc73af',
                 'directory': 'test_internal',
                 'url': os.path.join(data_dir, 'test_without_ref_labels.zip'),
             },
@@ -51,7 +69,9 @@ class TestETCI2021:
         assert isinstance(x, dict)
         assert isinstance(x['image'], torch.Tensor)
         assert isinstance(x['mask'], torch.Tensor)
-        assert x['image'].shape[0] == 6
+        assert x['image'].dtype == torch.uint8
+        assert x['mask'].dtype == torch.uint8
+        assert x['image'].shape[0] == 2
         assert x['image'].shape[-2:] == x['mask'].shape[-2:]
 
         if dataset.split != 'test':
@@ -59,6 +79,236 @@ class TestETCI2021:
         else:
             assert x['mask'].shape[0] == 1
 
+    def test_pillow_backend(self, dataset: ETCI2021, monkeypatch: MonkeyPatch) -> None:
+        image, mask = expected(dataset, 0)
+        assert image.any() and mask.any()
+        x = dataset[0]
+        monkeypatch.setattr(torchgeo.datasets.etci2021, '_PNG_BACKEND', 'pillow')
+        y = dataset[0]
+        for sample in [x, y]:
+            assert torch.equal(sample['image'], image)
+            assert torch.equal(sample['mask'], mask)
+
+    def test_files_cache(self, dataset: ETCI2021) -> None:
+        cache = os.path.join(dataset.root, f'.etci2021_{dataset.split}_files.json')
+        assert not os.path.exists(cache)
+        ETCI2021(dataset.root, dataset.split, cache=True)
+        assert os.path.exists(cache)
+
+        # Up-to-date cache is reused
+        with open(cache) as f:
+            cached = json.load(f)
+        files = {k: v[:1] for k, v in cached['files'].items()}
+        with open(cache, 'w') as f:
+            json.dump({'key': cached['key'], 'files': files}, f)
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert ds.files == files
+
+        # Stale cache is rebuilt
+        directory = dataset.metadata[dataset.split]['directory']
+        region = sorted(os.listdir(os.path.join(dataset.root, directory)))[0]
+        os.utime(os.path.join(dataset.root, directory, region, 'tiles', 'vv'), (0, 0))
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert ds.files == dataset.files
+
+        # Invalid cache is rebuilt
+        for contents in ['', '{', '1', '{"files": {}}', '\udcff']:
+            with open(cache, 'w', errors='surrogateescape') as f:
+                f.write(contents)
+            ds = ETCI2021(dataset.root, dataset.split, cache=True)
+            assert ds.files == dataset.files
+
+    def test_no_pool(self, dataset: ETCI2021) -> None:
+        dataset[0]
+        assert dataset._pool is None
+
+    @pytest.mark.parametrize('num_threads', [1, 4])
+    def test_num_threads(self, dataset: ETCI2021, num_threads: int) -> None:
+        ds = ETCI2021(dataset.root, dataset.split, num_threads=num_threads)
+        for i in range(len(ds)):
+            x = ds[i]
+            image, mask = expected(dataset, i)
+            assert torch.equal(x['image'], image)
+            assert torch.equal(x['mask'], mask)
+        assert ds._pool is not None
+        assert ds._pool._max_workers == num_threads
+        assert ds._prefetch == {}
+
+    def test_pool_per_process(
+        self, dataset: ETCI2021, monkeypatch: MonkeyPatch
+    ) -> None:
+        ds = ETCI2021(dataset.root, dataset.split, num_threads=2)
+        ds[0]
+        pool = ds._pool
+        ds[1]
+        assert ds._pool is pool
+        monkeypatch.setattr(os, 'getpid', lambda: -1)
+        ds[0]
+        assert ds._pool is not pool
+
+    @pytest.mark.parametrize('cache', [False, True])
+    def test_pickle(self, dataset: ETCI2021, cache: bool) -> None:
+        ds = ETCI2021(dataset.root, dataset.split, prefetch=True, cache=cache)
+        assert ds._pool is None
+        ds[0]
+        ds = pickle.loads(pickle.dumps(ds))
+        assert ds._pool is None
+        assert ds._prefetch == {}
+        assert ds._images is None
+        assert ds._masks is None
+        x = ds[0]
+        assert torch.equal(x['image'], dataset[0]['image'])
+
+    def test_prefetch(self, dataset: ETCI2021) -> None:
+        ds = ETCI2021(dataset.root, dataset.split, prefetch=True)
+        ds[0]
+        assert ds._pool is not None
+        assert ds._pool._max_workers == 1
+        assert list(ds._prefetch) == [1]
+        # Sequential, random, and repeated access all return the right sample
+        for i, prefetched in [(1, [2]), (0, [1]), (2, []), (2, [])]:
+            x = ds[i]
+            assert list(ds._prefetch) == prefetched
+            image, mask = expected(dataset, i)
+            assert torch.equal(x['image'], image)
+            assert torch.equal(x['mask'], mask)
+
+    @pytest.mark.parametrize(
+        'memory_format', [torch.contiguous_format, torch.channels_last]
+    )
+    @pytest.mark.parametrize('cache', [False, True])
+    def test_memory_format(
+        self, dataset: ETCI2021, memory_format: torch.memory_format, cache: bool
+    ) -> None:
+        ds = ETCI2021(
+            dataset.root, dataset.split, memory_format=memory_format, cache=cache
+        )
+        for i in range(len(ds)):
+            x = ds[i]
+            image, _ = expected(dataset, i)
+            assert torch.equal(x['image'], image)
+            if memory_format == torch.channels_last:
+                assert x['image'].permute(1, 2, 0).is_contiguous()
+            else:
+                assert x['image'].is_contiguous()
+
+    def test_invalid_memory_format(self, dataset: ETCI2021) -> None:
+        with pytest.raises(AssertionError):
+            ETCI2021(dataset.root, memory_format=torch.preserve_format)
+
+    def test_load_target(
+        self, dataset: ETCI2021, tmp_path: Path, monkeypatch: MonkeyPatch
+    ) -> None:
+        path = os.path.join(tmp_path, 'mask.png')
+        Image.fromarray(np.array([[0, 255], [128, 0]], dtype=np.uint8)).save(path)
+        mask = dataset._load_target(path)
+        assert mask.dtype == torch.uint8
+        assert mask.tolist() == [[0, 1], [1, 0]]
+        monkeypatch.setattr(torchgeo.datasets.etci2021, '_PNG_BACKEND', 'pillow')
+        assert torch.equal(dataset._load_target(path), mask)
+
+    def test_cache(self, dataset: ETCI2021) -> None:
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        for path in ds._cache_paths():
+            assert os.path.exists(path)
+        for i in range(len(ds)):
+            image, mask = expected(dataset, i)
+            assert image.any() and mask.any()
+            x = ds[i]
+            assert torch.equal(x['image'], image)
+            assert torch.equal(x['mask'], mask)
+
+        # Existing cache is reused, also after pickling
+        ds = ETCI2021(
+            dataset.root, dataset.split, memory_format=torch.channels_last, cache=True
+        )
+        ds = pickle.loads(pickle.dumps(ds))
+        assert ds._images is None
+        x = ds[0]
+        assert x['image'].permute(1, 2, 0).is_contiguous()
+        assert torch.equal(x['image'], expected(dataset, 0)[0])
+
+    def test_cache_invalid(self, dataset: ETCI2021, monkeypatch: MonkeyPatch) -> None:
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        ds = pickle.loads(pickle.dumps(ds))
+        for path in ds._cache_paths():
+            os.remove(path)
+        with pytest.raises(RuntimeError, match='was removed or changed'):
+            ds[0]
+
+        monkeypatch.setattr(ETCI2021, '_open_cache', lambda self: False)
+        with pytest.raises(RuntimeError, match='after building it'):
+            ETCI2021(dataset.root, dataset.split, cache=True)
+
+    def test_cache_race(self, dataset: ETCI2021, monkeypatch: MonkeyPatch) -> None:
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+
+        def replace(src: str, dst: str) -> None:
+            raise PermissionError
+
+        # Another process already built the cache
+        monkeypatch.setattr(os, 'replace', replace)
+        ds._build_cache()
+        assert not [name for name in os.listdir(dataset.root) if name.endswith('.tmp')]
+
+        # No cache to fall back on
+        for path in ds._cache_paths():
+            os.remove(path)
+        with pytest.raises(PermissionError):
+            ds._build_cache()
+
+    def test_cache_stale(self, dataset: ETCI2021) -> None:
+        ds = ETCI2021(dataset.root, dataset.split)
+        images, masks, key = ds._cache_paths()
+        with open(key, 'w') as f:
+            f.write(ds._cache_key())
+        # Wrong number of samples
+        np.save(images, np.zeros((1, 2, 64, 64), dtype=np.uint8))
+        np.save(masks, np.zeros((1, 2, 64, 64), dtype=np.uint8))
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert ds._images is not None
+        assert len(ds._images) == len(ds)
+
+        # Wrong number of channels
+        np.save(images, np.zeros((len(ds), 6, 64, 64), dtype=np.uint8))
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert ds._images is not None
+        assert ds._images.shape[1] == 2
+        np.save(masks, np.zeros((len(ds), 3, 64, 64), dtype=np.uint8))
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert ds._masks is not None
+        assert ds._masks.shape[1] == len(ds[0]['mask'])
+
+        # Wrong tile size
+        np.save(images, np.zeros((len(ds), 2, 64, 64), dtype=np.uint8))
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert ds._images is not None
+        assert ds._images.shape[2:] == ds[0]['image'].shape[1:]
+
+        # Wrong dtype
+        np.save(masks, np.zeros((len(ds), *ds[0]['mask'].shape), dtype=np.int64))
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert ds._masks is not None
+        assert ds._masks.dtype == np.uint8
+
+        # Different list of samples
+        ds.files = {k: v[:1] for k, v in ds.files.items()}
+        assert not ds._open_cache()
+        with open(key, 'w') as f:
+            f.write('')
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        with open(key) as f:
+            assert f.read() == ds._cache_key()
+
+        # PNG replaced in place
+        path = ds.files['vh'][0]
+        with Image.open(path) as img:
+            array = 255 - np.array(img)
+        Image.fromarray(array).save(path)
+        os.utime(path, ns=(0, 0))
+        ds = ETCI2021(dataset.root, dataset.split, cache=True)
+        assert torch.equal(ds[0]['image'][1], torch.from_numpy(array[..., 0]))
+
     def test_len(self, dataset: ETCI2021) -> None:
         assert len(dataset) == 3
 
@@ -21,19 +21,8 @@ class ETCI2021DataModule(NonGeoDataModule):
     .. versionadded:: 0.2
     """
 
-    mean = torch.tensor(
-        [
-            128.02253931,
-            128.02253931,
-            128.02253931,
-            128.11221701,
-            128.11221701,
-            128.11221701,
-        ]
-    )
-    std = torch.tensor(
-        [89.8145088, 89.8145088, 89.8145088, 95.2797861, 95.2797861, 95.2797861]
-    )
+    mean = torch.tensor([128.02253931, 128.11221701])
+    std = torch.tensor([89.8145088, 95.2797861])
 
     def __init__(
         self, batch_size: int = 64, num_workers: int = 0, **kwargs: Any
@@ -74,9 +63,20 @@ class ETCI2021DataModule(NonGeoDataModule):
         Returns:
             A batch of data.
         """
+        # Images are stored as uint8, normalization requires float
+        batch['image'] = batch['image'].float()
+
         if self.trainer:
             if not self.trainer.predicting:
                 # Evaluate against flood mask, not water mask
                 batch['mask'] = (batch['mask'][:, 1] > 0).long()
 
-        return super().on_after_batch_transfer(batch, dataloader_idx)
+        batch = super().on_after_batch_transfer(batch, dataloader_idx)
+
+        # Collation in worker processes stacks samples into a contiguous batch
+        if self.kwargs.get('memory_format') == torch.channels_last:
+            batch['image'] = batch['image'].contiguous(
+                memory_format=torch.channels_last
+            )
+
+        return batch
@@ -3,10 +3,12 @@
 
 """ETCI 2021 dataset."""
 
-import glob
+import hashlib
+import json
 import os
 from collections.abc import Callable
-from typing import ClassVar
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, ClassVar, cast
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -19,6 +21,13 @@ from .errors import DatasetNotFoundError
 from .geo import NonGeoDataset
 from .utils import Path, download_and_extract_archive
 
+try:
+    import pyspng
+
+    _PNG_BACKEND = 'pyspng'
+except ImportError:
+    _PNG_BACKEND = 'pillow'
+
 
 class ETCI2021(NonGeoDataset):
     """ETCI 2021 Flood Detection dataset.
@@ -30,20 +39,36 @@ class ETCI2021(NonGeoDataset):
 
     * 33,405 VV & VH Sentinel-1 Synthetic Aperture Radar (SAR) images
     * 2 binary masks per image representing water body & flood, respectively
-    * 2 polarization band images (VV, VH) of 3 RGB channels per band
-    * 3 RGB channels per band generated by the Hybrid Pluggable Processing
-      Pipeline (hyp3)
+    * 2 polarization band images (VV, VH) generated by the Hybrid Pluggable
+      Processing Pipeline (hyp3)
     * Images with 5x20m per pixel resolution (256x256) px) taken in
       Interferometric Wide Swath acquisition mode
     * Flood events from 5 different regions
 
     Dataset format:
 
-    * VV band three-channel png
-    * VH band three-channel png
+    * VV band three-channel png, all channels are identical
+    * VH band three-channel png, all channels are identical
     * water body mask single-channel png where no water body = 0, water body = 255
     * flood mask single-channel png where no flood = 0, flood = 255
 
+    If the optional `pyspng <https://github.com/nurpax/pyspng>`_ package is
+    installed, PNGs are decoded with libspng, which is considerably faster than
+    Pillow. Otherwise, Pillow is used.
+
+    Only one channel of each band is read, so images have 2 channels (VV, VH).
+    They are returned as uint8 tensors with values in [0, 255]. Conversion to
+    floating point is left to the transforms, ideally after the batch has been
+    moved to the GPU, e.g. ``image.to(torch.float32).div_(255)``. Masks are
+    returned as uint8 tensors with values in {0, 1}, cast them with ``.long()``
+    where a loss function requires int64 class indices.
+
+    Decode threads and cache memory maps are created lazily in each process and
+    are not pickled, so the dataset is cheap to send to DataLoader workers with
+    any start method. Use it with, e.g., ``DataLoader(dataset, num_workers=8,
+    persistent_workers=True, prefetch_factor=4)`` so that each worker sets them
+    up only once rather than every epoch.
+
     Dataset classes:
 
     1. no flood/water
@@ -55,6 +80,10 @@ class ETCI2021(NonGeoDataset):
         The authors would like to thank the NASA Earth Science Data Systems Program,
         NASA Digital Transformation AI/ML thrust, and IEEE GRSS for organizing
         the ETCI competition.
+
+    .. versionchanged:: 0.7
+       *image* has 2 channels instead of 6 and is returned as uint8 instead of
+       float32, *mask* is returned as uint8 instead of int64.
     """
 
     bands = ('VV', 'VH')
@@ -87,6 +116,10 @@ class ETCI2021(NonGeoDataset):
         transforms: Callable[[dict[str, Tensor]], dict[str, Tensor]] | None = None,
         download: bool = False,
         checksum: bool = False,
+        prefetch: bool = False,
+        memory_format: torch.memory_format = torch.contiguous_format,
+        cache: bool = False,
+        num_threads: int = 0,
     ) -> None:
         """Initialize a new ETCI 2021 dataset instance.
 
@@ -97,17 +130,44 @@ class ETCI2021(NonGeoDataset):
                 entry and returns a transformed version
             download: if True, download dataset and store it in the root directory
             checksum: if True, check the MD5 of the downloaded files (may be slow)
+            prefetch: if True, start decoding sample ``index + 1`` in the background
+                when sample ``index`` is requested. Only useful for sequential
+                access, e.g. a DataLoader without shuffling
+            memory_format: memory layout of the image, either
+                ``torch.contiguous_format`` or ``torch.channels_last``, in which
+                case the channels of each pixel are adjacent in memory (HxWxC).
+                A DataLoader with workers collates samples into a contiguous
+                batch, :class:`~torchgeo.datamodules.ETCI2021DataModule`
+                restores the layout after transfer
+            cache: if True, decode all samples once into uncompressed memory-mapped
+                .npy files in *root* (about 0.25 MB per sample) and read from them
+                instead of the PNGs. The list of PNGs is also cached in *root*,
+                it cannot be cached without the decoded samples
+            num_threads: number of threads decoding the PNGs of a sample
+                concurrently, 0 to decode them one by one in the calling thread.
+                Only helps if the PNG decoder releases the GIL. Each process
+                (e.g. DataLoader worker) starts its own threads on first use,
+                with *prefetch* at least one
 
         Raises:
-            AssertionError: if ``split`` argument is invalid
+            AssertionError: if ``split`` or ``memory_format`` argument is invalid
             DatasetNotFoundError: If dataset is not found and *download* is False.
+            RuntimeError: If *cache* is True and the built cache is invalid.
+
+        .. versionadded:: 0.7
+           The *prefetch*, *memory_format*, *cache*, and *num_threads* parameters.
         """
         assert split in self.metadata.keys()
+        assert memory_format in (torch.contiguous_format, torch.channels_last)
 
         self.root = root
         self.split = split
         self.transforms = transforms
         self.checksum = checksum
+        self.prefetch = prefetch
+        self.memory_format = memory_format
+        self.cache = cache
+        self.num_threads = num_threads
 
         if download:
             self._download()
@@ -117,6 +177,21 @@ class ETCI2021(NonGeoDataset):
 
         self.files = self._load_files(self.root, self.split)
 
+        # Created lazily in each process, see _get_pool
+        self._pool: ThreadPoolExecutor | None = None
+        self._pool_pid: int | None = None
+        self._prefetch: dict[int, dict[str, Future[Tensor]]] = {}
+
+        self._images: np.typing.NDArray[np.uint8] | None = None
+        self._masks: np.typing.NDArray[np.uint8] | None = None
+        if self.cache and not self._open_cache():
+            self._build_cache()
+            if not self._open_cache():
+                raise RuntimeError(
+                    f'Cache of the {split!r} split in {root} does not match the '
+                    'dataset after building it, do all tiles have the same size?'
+                )
+
     def __getitem__(self, index: int) -> dict[str, Tensor]:
         """Return an index within the dataset.
 
@@ -126,18 +201,11 @@ class ETCI2021(NonGeoDataset):
         Returns:
             data and label at that index
         """
-        files = self.files[index]
-        vv = self._load_image(files['vv'])
-        vh = self._load_image(files['vh'])
-        water_mask = self._load_target(files['water_mask'])
-
-        if self.split != 'test':
-            flood_mask = self._load_target(files['flood_mask'])
-            mask = torch.stack(tensors=[water_mask, flood_mask], dim=0)
+        if self.cache:
+            image, mask = self._load_cached(index)
         else:
-            mask = water_mask.unsqueeze(0)
+            image, mask = self._load_sample(index)
 
-        image = torch.cat(tensors=[vv, vh], dim=0)
         sample = {'image': image, 'mask': mask}
 
         if self.transforms is not None:
@@ -151,9 +219,273 @@ class ETCI2021(NonGeoDataset):
         Returns:
             length of the dataset
         """
-        return len(self.files)
+        return len(self.files['vv'])
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Define how instances are pickled.
+
+        Returns:
+            the state necessary to unpickle the instance
+        """
+        # Thread pools cannot be pickled, workers create their own. Memory maps
+        # would be pickled by value, workers reopen them instead.
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pool_pid'] = None
+        state['_prefetch'] = {}
+        state['_images'] = None
+        state['_masks'] = None
+        return state
+
+    def _load_sample(self, index: int) -> tuple[Tensor, Tensor]:
+        """Decode the image and mask of a single sample from the PNGs.
+
+        Args:
+            index: index of the sample
+
+        Returns:
+            the image and mask
+        """
+        if self.prefetch or self.num_threads > 0:
+            pool = self._get_pool()
+            futures = self._prefetch.pop(index, None) or self._submit(pool, index)
+
+            # Any other pending prefetch was not requested next, e.g. random access
+            for stale in self._prefetch.values():
+                for future in stale.values():
+                    future.cancel()
+            self._prefetch.clear()
+
+            if self.prefetch and index + 1 < len(self):
+                self._prefetch[index + 1] = self._submit(pool, index + 1)
+
+            tensors = {key: future.result() for key, future in futures.items()}
+        else:
+            tensors = {
+                key: self._load_file(key, paths[index])
+                for key, paths in self.files.items()
+            }
+
+        if self.split != 'test':
+            mask = torch.stack(
+                tensors=[tensors['water_mask'], tensors['flood_mask']], dim=0
+            )
+        else:
+            mask = tensors['water_mask'].unsqueeze(0)
+
+        # Copy both bands straight into the final image
+        vv, vh = tensors['vv'], tensors['vh']
+        image = self._empty_image(2, *vv.shape)
+        image[0] = vv
+        image[1] = vh
+
+        return image, mask
+
+    def _load_cached(self, index: int) -> tuple[Tensor, Tensor]:
+        """Load the image and mask of a single sample from the cache.
+
+        Args:
+            index: index of the sample
+
+        Returns:
+            the image and mask
+        """
+        if self._images is None or self._masks is None:
+            if not self._open_cache():
+                raise RuntimeError(
+                    f'Cache of the {self.split!r} split in {self.root} was removed '
+                    'or changed, create the dataset again to rebuild it'
+                )
+        assert self._images is not None and self._masks is not None
+
+        # Copy-on-write memory maps, no data is read until accessed
+        image = torch.from_numpy(self._images[index])
+        mask = torch.from_numpy(self._masks[index])
+        if self.memory_format == torch.channels_last:
+            image = self._empty_image(*image.shape).copy_(image)
+
+        return image, mask
+
+    def _empty_image(self, c: int, h: int, w: int) -> Tensor:
+        """Allocate an uninitialized image in :attr:`memory_format`.
+
+        Args:
+            c: number of channels
+            h: height
+            w: width
+
+        Returns:
+            the CxHxW uint8 image
+        """
+        if self.memory_format == torch.channels_last:
+            return torch.empty((h, w, c), dtype=torch.uint8).permute((2, 0, 1))
+        return torch.empty((c, h, w), dtype=torch.uint8)
+
+    def _cache_paths(self) -> tuple[str, str, str]:
+        """Return the paths of the memory-mapped cache files.
+
+        Returns:
+            the paths of the image and mask .npy files and of the file list hash
+        """
+        images = os.path.join(self.root, f'etci2021_{self.split}_images.npy')
+        masks = os.path.join(self.root, f'etci2021_{self.split}_masks.npy')
+        key = os.path.join(self.root, f'etci2021_{self.split}_files.sha256')
+        return images, masks, key
 
-    def _load_files(self, root: Path, split: str) -> list[dict[str, str]]:
+    def _cache_key(self) -> str:
+        """Hash the list of PNGs the cache is built from.
+
+        PNGs replaced in place, e.g. re-downloaded, change their size or mtime.
+
+        Returns:
+            the SHA-256 of the paths relative to *root*, sizes, and mtimes
+        """
+        sha256 = hashlib.sha256()
+        for paths in self.files.values():
+            for path in paths:
+                stat = os.stat(path)
+                relpath = os.path.relpath(path, self.root)
+                sha256.update(
+                    f'{relpath}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode()
+                )
+        return sha256.hexdigest()
+
+    def _open_cache(self) -> bool:
+        """Memory-map the cache files.
+
+        Returns:
+            True if the cache exists and matches the dataset, else False
+        """
+        images_path, masks_path, key_path = self._cache_paths()
+        try:
+            with open(key_path) as f:
+                key = f.read()
+            images = np.load(images_path, mmap_mode='c')
+            masks = np.load(masks_path, mmap_mode='c')
+        except (OSError, ValueError):
+            return False
+
+        if key != self._cache_key():
+            return False
+
+        # Only the PNG header is read to get the size of the tiles
+        with Image.open(self.files['vv'][0]) as img:
+            width, height = img.size
+        num_masks = 1 if self.split == 'test' else 2
+        if images.shape != (len(self), 2, height, width):
+            return False
+        if masks.shape != (len(self), num_masks, height, width):
+            return False
+        if images.dtype != np.uint8 or masks.dtype != np.uint8:
+            return False
+
+        self._images = images
+        self._masks = masks
+        return True
+
+    def _build_cache(self) -> None:
+        """Decode all samples once and write them to the cache files."""
+        image, mask = self._load_sample(0)
+        images_path, masks_path, key_path = self._cache_paths()
+
+        # Write to temporary files so that an interrupted build is not mistaken
+        # for a complete cache. Each process, e.g. DDP rank, writes its own.
+        suffix = f'.{os.getpid()}.tmp'
+        images_tmp, masks_tmp, key_tmp = (
+            path + suffix for path in (images_path, masks_path, key_path)
+        )
+        try:
+            images = np.lib.format.open_memmap(
+                images_tmp, mode='w+', dtype=np.uint8, shape=(len(self), *image.shape)
+            )
+            masks = np.lib.format.open_memmap(
+                masks_tmp, mode='w+', dtype=np.uint8, shape=(len(self), *mask.shape)
+            )
+            images[0] = image.numpy()
+            masks[0] = mask.numpy()
+            for i in range(1, len(self)):
+                image, mask = self._load_sample(i)
+                images[i] = image.numpy()
+                masks[i] = mask.numpy()
+
+            images.flush()
+            masks.flush()
+            del images, masks
+            with open(key_tmp, 'w') as f:
+                f.write(self._cache_key())
+
+            # Processes building concurrently write identical files, the last
+            # rename wins. The key is renamed last, a cache without a matching
+            # key is rebuilt.
+            try:
+                os.replace(images_tmp, images_path)
+                os.replace(masks_tmp, masks_path)
+                os.replace(key_tmp, key_path)
+            except OSError:
+                # E.g. on Windows, a cache another process has already mapped
+                # cannot be replaced, use that one
+                if not self._open_cache():
+                    raise
+        finally:
+            for path in (images_tmp, masks_tmp, key_tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        # Samples are read from the cache from now on, don't keep idle threads
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self._pool_pid = None
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        """Return the thread pool used to decode images.
+
+        Threads do not survive a fork, so each DataLoader worker gets its own pool.
+
+        Returns:
+            the thread pool of the current process
+        """
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            self._pool = ThreadPoolExecutor(max_workers=max(self.num_threads, 1))
+            self._pool_pid = pid
+            # Pending futures belong to the pool of the parent process
+            self._prefetch = {}
+        return self._pool
+
+    def _submit(
+        self, pool: ThreadPoolExecutor, index: int
+    ) -> dict[str, Future[Tensor]]:
+        """Start decoding all PNGs of a single sample.
+
+        Args:
+            pool: thread pool to decode in
+            index: index of the sample
+
+        Returns:
+            futures of the decoded images and masks, keyed like :attr:`files`
+        """
+        futures = {}
+        for key, paths in self.files.items():
+            futures[key] = pool.submit(self._load_file, key, paths[index])
+        return futures
+
+    def _load_file(self, key: str, path: Path) -> Tensor:
+        """Decode a single PNG of a sample.
+
+        Args:
+            key: kind of file, one of the keys of :attr:`files`
+            path: path to the PNG
+
+        Returns:
+            the HxW uint8 image or binary mask
+        """
+        if key in ('vv', 'vh'):
+            return self._load_image(path)
+        else:
+            return self._load_target(path)
+
+    def _load_files(self, root: Path, split: str) -> dict[str, list[str]]:
         """Return the paths of the files in the dataset.
 
         Args:
@@ -161,39 +493,94 @@ class ETCI2021(NonGeoDataset):
             split: subset of dataset, one of [train, val, test]
 
         Returns:
-            list of dicts containing paths for each pair of vv, vh,
+            dict of parallel lists containing paths for each vv, vh,
             water body mask, flood mask (train/val only)
         """
-        files = []
         directory = self.metadata[split]['directory']
-        folders = sorted(glob.glob(os.path.join(root, directory, '*')))
-        folders = [os.path.join(folder, 'tiles') for folder in folders]
-        for folder in folders:
-            vvs = sorted(glob.glob(os.path.join(folder, 'vv', '*.png')))
-            vhs = [vv.replace('vv', 'vh') for vv in vvs]
-            water_masks = [
-                vv.replace('_vv.png', '.png').replace('vv', 'water_body_label')
-                for vv in vvs
+        dirpath = os.path.join(root, directory)
+
+        # Sort by folder name only, hidden entries are skipped like glob does
+        with os.scandir(dirpath) as it:
+            regions = sorted(
+                e.name for e in it if e.is_dir() and not e.name.startswith('.')
+            )
+        folders = [os.path.join(dirpath, region, 'tiles') for region in regions]
+
+        # With cache=True, reuse the file list from a previous instantiation if
+        # no VV directory has been modified since
+        cache = os.path.join(root, f'.etci2021_{split}_files.json')
+        if self.cache:
+            key = [
+                folders,
+                [os.stat(os.path.join(folder, 'vv')).st_mtime_ns for folder in folders],
             ]
+            try:
+                with open(cache) as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                # Missing or truncated, rebuild the list
+                cached = None
+            if isinstance(cached, dict) and cached.get('key') == key:
+                return cast(dict[str, list[str]], cached['files'])
+
+        keys = ['vv', 'vh', 'water_mask']
+        if split != 'test':
+            keys.append('flood_mask')
+        files: dict[str, list[str]] = {key: [] for key in keys}
 
-            if split != 'test':
-                flood_masks = [
-                    vv.replace('_vv.png', '.png').replace('vv', 'flood_label')
-                    for vv in vvs
-                ]
-
-                for vv, vh, flood_mask, water_mask in zip(
-                    vvs, vhs, flood_masks, water_masks
-                ):
-                    files.append(
-                        dict(vv=vv, vh=vh, flood_mask=flood_mask, water_mask=water_mask)
+        for folder in folders:
+            # Derive all paths from the VV filename stem, e.g.
+            # vv/<stem>_vv.png -> vh/<stem>_vh.png, water_body_label/<stem>.png
+            with os.scandir(os.path.join(folder, 'vv')) as it:
+                names = sorted(e.name for e in it if e.name.endswith('_vv.png'))
+
+            for name in names:
+                stem = name[: -len('_vv.png')]
+                files['vv'].append(os.path.join(folder, 'vv', name))
+                files['vh'].append(os.path.join(folder, 'vh', f'{stem}_vh.png'))
+                files['water_mask'].append(
+                    os.path.join(folder, 'water_body_label', f'{stem}.png')
+                )
+                if split != 'test':
+                    files['flood_mask'].append(
+                        os.path.join(folder, 'flood_label', f'{stem}.png')
                     )
-            else:
-                for vv, vh, water_mask in zip(vvs, vhs, water_masks):
-                    files.append(dict(vv=vv, vh=vh, water_mask=water_mask))
+
+        if self.cache:
+            # Write to a temporary file so that concurrent readers never see a
+            # partially written list
+            tmp = f'{cache}.{os.getpid()}.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump({'key': key, 'files': files}, f)
+                os.replace(tmp, cache)
+            except OSError:
+                # Read-only root, the file list is simply rebuilt next time
+                pass
 
         return files
 
+    def _load_png(self, path: Path) -> np.typing.NDArray[np.uint8]:
+        """Load a single-channel PNG.
+
+        Args:
+            path: path to the PNG
+
+        Returns:
+            the HxW array
+        """
+        array: np.typing.NDArray[np.uint8]
+        if _PNG_BACKEND == 'pyspng':
+            with open(path, 'rb') as f:
+                array = pyspng.load(f.read())
+            # All channels are identical, keep only the first one
+            if array.ndim == 3:
+                array = array[..., 0]
+        else:
+            with Image.open(path) as img:
+                array = np.array(img if img.mode == 'L' else img.convert('L'))
+        return array
+
     def _load_image(self, path: Path) -> Tensor:
         """Load a single image.
 
@@ -201,15 +588,11 @@ class ETCI2021(NonGeoDataset):
             path: path to the image
 
         Returns:
-            the image
+            the HxW uint8 image
         """
-        filename = os.path.join(path)
-        with Image.open(filename) as img:
-            array: np.typing.NDArray[np.int_] = np.array(img.convert('RGB'))
-            tensor = torch.from_numpy(array).float()
-            # Convert from HxWxC to CxHxW
-            tensor = tensor.permute((2, 0, 1))
-            return tensor
+        array = self._load_png(path)
+        tensor = torch.from_numpy(array)
+        return tensor
 
     def _load_target(self, path: Path) -> Tensor:
         """Load the target mask for a single image.
@@ -220,13 +603,10 @@ class ETCI2021(NonGeoDataset):
         Returns:
             the target mask
         """
-        filename = os.path.join(path)
-        with Image.open(filename) as img:
-            array: np.typing.NDArray[np.int_] = np.array(img.convert('L'))
-            tensor = torch.from_numpy(array)
-            tensor = torch.clamp(tensor, min=0, max=1)
-            tensor = tensor.to(torch.long)
-            return tensor
+        # Binarize in a single vectorized pass, bool and uint8 share a layout
+        array = np.greater(self._load_png(path), 0).view(np.uint8)
+        tensor = torch.from_numpy(array)
+        return tensor
 
     def _check_integrity(self) -> bool:
         """Checks the integrity of the dataset structure.
@@ -269,8 +649,8 @@ class ETCI2021(NonGeoDataset):
         Returns:
             a matplotlib Figure with the rendered sample
         """
-        vv = np.rollaxis(sample['image'][:3].numpy(), 0, 3)
-        vh = np.rollaxis(sample['image'][3:].numpy(), 0, 3)
+        vv = sample['image'][0].numpy()
+        vh = sample['image'][1].numpy()
         mask = sample['mask'].squeeze(0)
 
         showing_flood_mask = mask.shape[0] == 2
@@ -288,9 +668,9 @@ class ETCI2021(NonGeoDataset):
             num_panels += 1
 
         fig, axs = plt.subplots(1, num_panels, figsize=(num_panels * 4, 3))
-        axs[0].imshow(vv)
+        axs[0].imshow(vv, cmap='gray')
         axs[0].axis('off')
-        axs[1].imshow(vh)
+        axs[1].imshow(vh, cmap='gray')
         axs[1].axis('off')
         axs[2].imshow(water_mask)
         axs[2].axis('off')